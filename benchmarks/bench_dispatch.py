@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+测量handlers.py中每个URL函数经过RequestHandler分发时的参数处理开销
+URL函数本身被替换成空函数，不访问数据库
+app_env=dev python3 benchmarks/bench_dispatch.py [次数]
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+os.environ.setdefault('app_env', 'dev')
+logging.disable(logging.INFO)
+
+import handlers  # noqa: E402
+from coroweb import RequestHandler  # noqa: E402
+
+
+class FakeRequest(object):
+    """只提供RequestHandler用到的属性"""
+
+    def __init__(self, method, match_info, query_string='', body=None):
+        self.method = method
+        self.match_info = match_info
+        self.query_string = query_string
+        self.content_type = 'application/json' if body is not None else ''
+        self._body = body
+        self.__user__ = None
+
+    async def json(self):
+        return self._body
+
+
+def make_request(fn, h):
+    match_info = {k: 'x' for k in re.findall(r'{(\w+)}', fn.__route__)}
+    if fn.__method__ == 'POST':
+        return FakeRequest('POST', match_info, body={
+            k: 'v' for k in h._name_kw_args if k not in match_info})
+    qs = '&'.join('{}=1'.format(k) for k in h._name_kw_args if k not in match_info)
+    return FakeRequest('GET', match_info, qs)
+
+
+async def noop(**kw):
+    return kw
+
+
+async def run(h, request, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        await h(request)
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop = asyncio.new_event_loop()
+    for name in sorted(dir(handlers)):
+        fn = getattr(handlers, name)
+        if not callable(fn) or not getattr(fn, '__route__', None):
+            continue
+        h = RequestHandler(None, fn)
+        h._func = noop
+        t = loop.run_until_complete(run(h, make_request(fn, h), n))
+        print('{:<6} {:<28} {:>6.2f} us/call'.format(fn.__method__, fn.__route__, t * 1e6))
+
+
+if __name__ == '__main__':
+    main()
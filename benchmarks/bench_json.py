@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+比较API返回值几种序列化方式的耗时，数据模拟/api/comments和/api/blogs（不查询正文）的一页返回
+python3 benchmarks/bench_json.py [条数]
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import serializer  # noqa: E402
+from apis import Page  # noqa: E402
+from models import Blog, Comment, next_id  # noqa: E402
+
+
+def to_records(model, items, fields):
+    """按findAll(fields=..., compact=True)的方式生成Record"""
+    columns = (model.__primary_key__,) + tuple(fields)
+    make = model.__record__._for_columns(columns)._make
+    return [make(columns, [o[k] for k in columns]) for o in items]
+
+
+def make_comments(n):
+    comments = [Comment(id=next_id(), blog_id=next_id(), user_id=next_id(),
+                        user_name='user{}'.format(i), user_image='http://www.gravatar.com/avatar/x',
+                        content='评论内容' * 20, created_at=time.time()) for i in range(n)]
+    records = to_records(Comment, comments, Comment.__fields__)
+    page = Page(n * 10, 1, n)
+    return dict(page=page, comments=comments), dict(page=page, comments=records)
+
+
+def make_blogs(n):
+    """列表页defer=('content',)"""
+    fields = Blog._normalize_fields(None, ('content',))
+    blogs = [Blog(id=next_id(), user_id=next_id(), user_name='user{}'.format(i),
+                  user_image='http://www.gravatar.com/avatar/x', name='标题{}'.format(i),
+                  summary='摘要' * 50, created_at=time.time()) for i in range(n)]
+    records = to_records(Blog, blogs, fields)
+    page = Page(n * 10, 1, n)
+    return dict(page=page, blogs=blogs), dict(page=page, blogs=records)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    data = [('comments', make_comments(n)), ('blogs deferred', make_blogs(n))]
+    cases = []
+    for name, (models, _) in data:
+        cases.append(('json default=__dict__ (before) {}'.format(name), lambda m=models: json.dumps(
+            m, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')))
+    for backend in ('json', 'orjson'):
+        if backend == 'orjson' and serializer.orjson is None:
+            print('orjson not installed, skip')
+            continue
+        dumps = serializer._backends[backend]
+        for name, (models, records) in data:
+            cases.append(('{} Model {}'.format(backend, name), lambda d=dumps, m=models: d(m)))
+            cases.append(('{} Record {}'.format(backend, name), lambda d=dumps, r=records: d(r)))
+    number = 1000
+    for name, fn in cases:
+        t = min(timeit.repeat(fn, number=number, repeat=3))
+        print('{:<44} {:>8.1f} us/op'.format(name, t / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+分别用asyncio默认事件循环和uvloop启动服务，比较/和/api/blogs的吞吐量
+需要可以连接的数据库，服务按config中的server配置监听
+python3 benchmarks/bench_server.py [请求数] [并发数]
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+
+import aiohttp
+
+WWW = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www')
+sys.path.insert(0, WWW)
+os.environ.setdefault('app_env', 'dev')
+
+from config import configs  # noqa: E402
+
+PATHS = ['/', '/api/blogs']
+
+
+def wait_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start on {}:{}'.format(host, port))
+
+
+async def fetch(session, url, n):
+    for _ in range(n):
+        async with session.get(url) as resp:
+            await resp.read()
+            if resp.status != 200:
+                raise RuntimeError('{} returned {}'.format(url, resp.status))
+
+
+async def run(url, total, concurrency):
+    """用concurrency个连接共发送total个请求，返回每秒请求数"""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await fetch(session, url, concurrency)  # 预热
+        start = time.perf_counter()
+        await asyncio.gather(*[fetch(session, url, total // concurrency)
+                               for _ in range(concurrency)])
+        return total // concurrency * concurrency / (time.perf_counter() - start)
+
+
+def bench(loop_name, total, concurrency):
+    host, port = configs.server.host, configs.server.port
+    env = dict(os.environ, app_loop=loop_name)
+    proc = subprocess.Popen([sys.executable, 'app.py', os.environ['app_env']], cwd=WWW, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(host, port)
+        results = {}
+        for path in PATHS:
+            url = 'http://{}:{}{}'.format(host, port, path)
+            results[path] = asyncio.run(run(url, total, concurrency))
+        return results
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    loops = ['asyncio']
+    try:
+        import uvloop  # noqa: F401
+        loops.append('uvloop')
+    except ImportError:
+        print('uvloop not installed, only asyncio')
+    results = {name: bench(name, total, concurrency) for name in loops}
+    for path in PATHS:
+        base = results['asyncio'][path]
+        for name in loops:
+            rps = results[name][path]
+            print('{:<12} {:<8} {:>9.1f} req/s  {:+6.1f}%'.format(
+                path, name, rps, (rps / base - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
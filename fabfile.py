@@ -23,6 +23,8 @@ def bulid():
     excludes = ['test.py', '.*', '*.pyc', '*.pyo']  # 不需要压缩的目录和文件
     local('rm -f dist/{}'.format(_TAR_FILE))  # local执行本地命令 删除上次的压缩文件
     with lcd(os.path.join(os.path.abspath('.'), 'www')):  # lcd用于切换本地目录进入www目录
+        local('python3 assets.py static')  # 生成带hash的静态文件和manifest.json，模板通过static()引用
+        local('python3 compress.py static')  # 为静态文件生成.gz/.br文件，由StaticHandler直接返回
         cmd = ['tar', '--dereference', '-czvf', '../dist/{}'.format(_TAR_FILE)]
         cmd.extend(['--exclude=\'{}\''.format(ex) for ex in excludes])
         cmd.extend(includes)
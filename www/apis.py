@@ -4,6 +4,7 @@
 __author__ = 'komorebi'
 
 import json
+import base64
 import logging
 import inspect
 import functools
@@ -60,8 +61,55 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    def to_dict(self):
+        return dict(item_count=self.item_count, page_count=self.page_count,
+                    page_index=self.page_index, page_size=self.page_size,
+                    offset=self.offset, limit=self.limit,
+                    has_next=self.has_next, has_previous=self.has_previous)
+
     def __str__(self):
         return 'item count: {}, page_count: {}, page_index: {}, page_size: {}, offset:{}, limit: {}'.format(
             self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
+
+
+def encode_cursor(direction, key):
+    """将翻页方向和(created_at, id)编码成不透明的游标令牌"""
+    raw = json.dumps([direction, key[0], key[1]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    """解析游标令牌，返回(方向, (created_at, id))，令牌不合法时抛出APIValueError"""
+    try:
+        direction, created_at, id = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, (float(created_at), str(id))
+    except (ValueError, TypeError, UnicodeError):
+        raise APIValueError('cursor', 'invalid cursor.')
+
+
+class CursorPage(object):
+    """存储游标分页信息，next和previous为翻页令牌，没有对应页时为None"""
+
+    def __init__(self, items, page_size=10, has_next=False, has_previous=False):
+        self.page_size = page_size
+        self.has_next = has_next and len(items) > 0
+        self.has_previous = has_previous and len(items) > 0
+        self.next = encode_cursor('next', (items[-1].created_at, items[-1].id)) \
+            if self.has_next else None
+        self.previous = encode_cursor('prev', (items[0].created_at, items[0].id)) \
+            if self.has_previous else None
+
+    def to_dict(self):
+        return dict(page_size=self.page_size, has_next=self.has_next,
+                    has_previous=self.has_previous, next=self.next, previous=self.previous)
+
+    def __str__(self):
+        return 'page_size: {}, next: {}, previous: {}'.format(
+            self.page_size, self.next, self.previous)
+
+    __repr__ = __str__
@@ -5,24 +5,35 @@ __author__ = 'komorebi'
 
 import time
 import json
+import functools
+import asyncio
+import random
+import hashlib
 import os
 import sys
+import tempfile
+from urllib import parse
 from aiohttp import web  # 异步框架aiohttp
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader  # 前端模板引擎jinja2
-from orm import create_pool
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache  # 前端模板引擎jinja2
+from orm import create_pool, start_request, PoolTimeoutError
+import serializer
+import context
+import compress
+import assets
+from executor import init_executor, run_cpu
 from coroweb import add_routes, add_static
+from cache import LRUCache
 import logging
 
 
-logging.basicConfig(level=logging.INFO)
-
-
 def init_jinja2(app, **kw):
     """
     该函数用来初始化jinja2环境
+    production为True时关闭auto_reload，启用字节码缓存，并在启动时预编译所有模板
     """
     logging.info('init jinja2...')
+    production = kw.get('production', False)
     """设置初始化jinja2的一些环境参数"""
     options = dict(
         autoescape=kw.get('autoescape', True),  # 为True表示自动转义
@@ -31,8 +42,13 @@ def init_jinja2(app, **kw):
         variable_start_string=kw.get('variable_start_string', '{{'),  # 变量开始标识
         variable_end_string=kw.get('variable_end_string', '}}'),  # 变量结束标识
         # 为True表示修改模版文件立即生效，刷新网页就可以看到修改后的效果
-        auto_reload=kw.get('auto_reload', True)
+        auto_reload=kw.get('auto_reload', not production)
     )
+    if production:  # 编译结果缓存到文件，重启后不需要重新编译
+        cache_dir = kw.get('bytecode_cache_dir', None) or os.path.join(
+            tempfile.gettempdir(), 'awesome-jinja2-cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
     path = kw.get('path', None)
     if path is None:
         """path即templates文件夹路径"""
@@ -49,14 +65,56 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():  # 将自定义的过滤器加入到系统自带的过滤器中
             env.filters[name] = f
+    env.globals['static'] = assets.static  # {{ static('js/awesome.js') }}返回带hash的url
+    if production:  # 预编译所有模板，模板有错误时启动直接失败
+        names = env.list_templates(extensions=['html'])
+        for name in names:
+            env.get_template(name)
+        logging.info('precompiled {} templates'.format(len(names)))
     app['__templating__'] = env  # 将env赋值给app['__templating__']
 
 
+_request_logger = logging.getLogger('awesome.request')
+
+
+def log_request(ctx, options):
+    """
+    请求结束后输出一条json格式的日志
+    出错(5xx)或超过slow_ms的请求总是以WARNING输出，其余请求按sample_rate采样输出
+    """
+    if (ctx.status or 500) >= 500 or ctx.elapsed() * 1000 >= options['slow_ms']:
+        level = logging.WARNING
+    elif options['sample_rate'] > 0 and random.random() < options['sample_rate']:
+        level = options['level']
+    else:
+        return
+    if _request_logger.isEnabledFor(level):
+        _request_logger.log(level, json.dumps(ctx.to_dict(), ensure_ascii=False))
+
+
 async def logger_factory(app, handler):
-    """打印请求方式和路由"""
+    """创建请求上下文，请求结束后输出一条请求日志"""
+    options = app['__request_log__']
+
     async def logger(request):
-        logging.info('Request: {} {}'.format(request.method, request.path))
-        return (await handler(request))
+        start_request()  # 为本请求创建读写分离的状态，gather()的子task共享该状态
+        ctx = context.begin(request.method, request.path)
+        h = request.match_info.handler
+        ctx.handler = getattr(getattr(h, '_func', h), '__name__', None)
+        try:
+            r = await handler(request)
+            ctx.status = getattr(r, 'status', 200)
+            if options['server_timing'] and isinstance(r, web.StreamResponse) and not r.prepared:
+                r.headers['Server-Timing'] = ctx.server_timing()
+            return r
+        except web.HTTPException as e:
+            ctx.status = e.status
+            raise
+        finally:
+            for problem in ctx.check(options['max_queries'], options['max_repeats']):
+                logging.warning('{} {} ({}): {}'.format(
+                    ctx.method, ctx.path, ctx.handler, problem))
+            log_request(ctx, options)
     return logger
 
 
@@ -66,19 +124,35 @@ async def data_factory(app, handler):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = await request.json()
-                logging.info('request json: {}'.format(str(request.__data__)))
+                logging.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: {}'.format(str(request.__data__)))
+                logging.debug('request form: %s', request.__data__)
         return (await handler(request))
     return parse_data
 
 
+def render_size(r):
+    """粗略估计模板渲染的工作量：字符串的长度，列表按每项200计算"""
+    size = 0
+    for v in r.values():
+        if isinstance(v, str):
+            size += len(v)
+        elif isinstance(v, (list, tuple)):
+            size += 200 * len(v)
+        elif isinstance(v, dict):
+            size += sum(len(x) for x in v.values() if isinstance(x, str))
+    return size
+
+
 async def response_factory(app, handler):
     """把任何类型的返回值最后都统一封装成一个web.Response对象"""
     async def response(request):
-        logging.info('Response handler...')
-        r = await handler(request)  # 这里的handler其实就是RequestHandler(app, fn)
+        try:
+            r = await handler(request)  # 这里的handler其实就是RequestHandler(app, fn)
+        except PoolTimeoutError as e:  # 数据库连接池耗尽
+            logging.warning('database pool exhausted: {} {}'.format(request.method, request.path))
+            return web.HTTPServiceUnavailable(text=str(e), headers={'Retry-After': '1'})
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -94,24 +168,20 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')  # 获取模版
             if template is None:
-                resp = web.Response(
-                    body=json.dumps(
-                        r,
-                        ensure_ascii=False,  # 汉字会正常显示不会被显示成ascii码表示
-                        default=lambda o: o.__dict__).encode('utf-8'))
-                """
-                json.dumps 当 default 被指定时，其应该是一个函数，每当某个对象无法被序列化时它会被调用。
-                它应该返回该对象的一个可以被 JSON 编码的版本或者引发一个 TypeError。
-                如果没有被指定，则会直接引发 TypeError。
-                __dict__属性：查看对象内部所有属性名和属性值组成的字典
-                """
+                resp = web.Response(body=serializer.dumps(r))  # 序列化方式见serializer.py
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__  # 返回user信息给前端展示
-                resp = web.Response(
-                    body=app['__templating__'].get_template(template).render(
-                        **r).encode('utf-8'))
+                start = time.time()
+                # 内容较多的页面放到执行器中渲染，避免阻塞其他请求
+                # 先绑定模板变量，避免与run_cpu自己的参数（size等）冲突
+                render = functools.partial(app['__templating__'].get_template(template).render, r)
+                body = (await run_cpu(render, size=render_size(r), picklable=False)).encode('utf-8')
+                ctx = context.current()
+                if ctx is not None:
+                    ctx.render_time += time.time() - start  # 记录模板渲染耗时
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html; charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -126,15 +196,102 @@ async def response_factory(app, handler):
     return response
 
 
+async def compress_factory(app, handler):
+    """
+    压缩动态响应：内容类型可压缩且大小超过min_size时，按Accept-Encoding使用br或gzip
+    带ETag的响应（页面缓存）压缩结果按ETag缓存，不用每次重新压缩
+    """
+    options = app['__compress__']
+    cache = app['__compress_cache__']
+
+    async def compress_response(request):
+        r = await handler(request)
+        if (not isinstance(r, web.Response) or r.body is None or not isinstance(r.body, bytes)
+                or len(r.body) < options['min_size'] or 'Content-Encoding' in r.headers
+                or not compress.is_compressible(r.content_type)):
+            return r
+        vary = r.headers.get('Vary')
+        if not vary:
+            r.headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            r.headers['Vary'] = vary + ', Accept-Encoding'
+        encoding = compress.choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return r
+        etag = r.headers.get('ETag')
+        body = cache.get((etag, encoding)) if etag else None
+        if body is None:
+            # 超过executor.min_size的响应在执行器中压缩，避免阻塞事件循环
+            body = await run_cpu(compress.compress, r.body, encoding, options['level'],
+                                 size=len(r.body))
+            if etag:
+                cache.set((etag, encoding), body)
+        r.body = body
+        r.headers['Content-Encoding'] = encoding
+        if etag and not etag.startswith('W/'):
+            r.headers['ETag'] = 'W/' + etag  # 压缩后内容不同，改为弱ETag
+        return r
+    return compress_response
+
+
+def page_cache_key(request, h):
+    """
+    页面缓存的key：路径加上处理函数接受的查询参数，忽略其他参数，
+    page参数按get_page_index的规则规范化，避免随意构造的url挤掉正常页面的缓存
+    """
+    params = []
+    for name in h._name_kw_args:
+        value = request.query.get(name)
+        if value is None or name in request.match_info:
+            continue
+        if name == 'page':
+            value = str(int(value)) if value.isdigit() and int(value) > 0 else '1'
+        params.append((name, value))
+    if not params:
+        return request.path
+    return '{}?{}'.format(request.path, parse.urlencode(sorted(params)))
+
+
+async def page_cache_factory(app, handler):
+    """
+    缓存匿名用户GET请求的页面，路由的缓存时间由@get(path, cache_ttl=...)指定
+    只缓存模板渲染的html页面，json（包括出错时返回的错误信息）不缓存
+    """
+    async def page_cache(request):
+        h = request.match_info.handler
+        ttl = getattr(h, '_cache_ttl', None)
+        if not ttl or request.method != 'GET' or request.cookies.get(COOKIE_NAME):
+            return (await handler(request))
+        cache = app['__page_cache__']
+        key = page_cache_key(request, h)
+        cached = cache.get(key)
+        if cached is None:
+            r = await handler(request)
+            if (not isinstance(r, web.Response) or r.status != 200 or r.body is None
+                    or r.content_type != 'text/html'):
+                return r
+            body = r.body
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            cached = (body, r.content_type, r.charset, etag)
+            cache.set(key, cached, expires=time.time() + ttl)
+        body, content_type, charset, etag = cached
+        if request.headers.get('If-None-Match') in (etag, 'W/' + etag):  # 压缩后为弱ETag
+            return web.Response(status=304, headers={'ETag': etag})
+        resp = web.Response(body=body, headers={'ETag': etag})
+        resp.content_type = content_type
+        resp.charset = charset
+        return resp
+    return page_cache
+
+
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('check user: {} {}'.format(request.method, request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)  # 从cookies获取cookie
         if cookie_str:
             user = await cookie2user(cookie_str)  # 根据cookie取得用户信息
             if user:
-                logging.info('set current user: {}'.format(user.email))
+                logging.debug('set current user: %s', user.email)
                 request.__user__ = user  # 将user赋值给request.__user__以便返回给前端
         if request.path.startswith(
                 '/manage/') and (request.__user__ is None or not request.__user__.admin):
@@ -159,7 +316,8 @@ def datetime_filter(t):
     return u'{}年{}月{}日'.format(dt.year, dt.month, dt.day)
 
 
-async def init():
+async def init(workers=1):
+    """workers为进程数，db.maxsize/minsize是所有进程合计的连接数，按进程数平分"""
 
     host = configs.db.host
     port = configs.db.port
@@ -172,26 +330,117 @@ async def init():
         port=port,
         user=user,
         password=password,
-        db=db)
-
-    app = web.Application(
-        middlewares=[
-            logger_factory,
-            response_factory,
-            auth_factory
-        ])  # 初始化一个web服务实例
-    init_jinja2(app, filter=dict(datetime=datetime_filter))
+        db=db,
+        minsize=max(1, configs.db.get('minsize', 1) // workers),
+        maxsize=max(1, configs.db.get('maxsize', 10) // workers),
+        acquire_timeout=configs.db.get('acquire_timeout', 5),
+        connect_timeout=configs.db.get('connect_timeout', 10),
+        pool_recycle=configs.db.get('pool_recycle', 3600),
+        count_ttl=configs.db.get('count_ttl', 300),
+        count_estimate_rows=configs.db.get('count_estimate_rows'),
+        replicas=configs.db.get('replicas'),
+        balance=configs.db.get('balance', 'round_robin'))
+
+    middlewares = [logger_factory]
+    compress_options = configs.get('compress', {})
+    if compress_options.get('enabled', True):  # 在页面缓存外层，缓存的是压缩前的内容
+        middlewares.append(compress_factory)
+    if configs.cache.get('page_enabled', True):  # 匿名页面缓存
+        middlewares.append(page_cache_factory)
+    middlewares.extend([response_factory, auth_factory])
+    app = web.Application(  # 初始化一个web服务实例
+        middlewares=middlewares,
+        client_max_size=configs.server.get('client_max_size', 1024 ** 2))
+    log_options = configs.get('logging', {})
+    app['__request_log__'] = dict(
+        level=logging.getLevelName(log_options.get('request_level', 'INFO')),
+        sample_rate=log_options.get('sample_rate', 1.0),
+        slow_ms=log_options.get('slow_ms', 1000),
+        max_queries=log_options.get('max_queries', 20),
+        max_repeats=log_options.get('max_repeats', 5),
+        server_timing=log_options.get('server_timing', True))
+    # 请求日志使用自己的级别，全局级别较高（如线上WARNING）时采样的请求日志仍然输出
+    _request_logger.setLevel(app['__request_log__']['level'])
+    app['__page_cache__'] = LRUCache(maxsize=configs.cache.get('page_size', 1000))
+    app['__compress__'] = dict(
+        min_size=compress_options.get('min_size', 1024),
+        level=compress_options.get('level', 6))
+    app['__compress_cache__'] = LRUCache(maxsize=configs.cache.get('page_size', 1000))
+    serializer.set_backend(configs.get('json_backend', 'auto'))
+    executor_options = configs.get('executor', {})
+    init_executor(
+        kind=executor_options.get('kind', 'thread'),
+        workers=executor_options.get('workers'),
+        min_size=executor_options.get('min_size', 20000))
+    init_jinja2(
+        app,
+        filter=dict(datetime=datetime_filter),
+        production=os.environ['app_env'] == 'pro',  # 线上环境使用生产模式
+        bytecode_cache_dir=configs.get('templates', {}).get('bytecode_cache_dir'))
     add_routes(app, 'handlers')  # 将handlers.py中所有路由添加到app中
     add_static(app)  # 添加静态资源目录
     return app
 
+
+def install_loop(name='auto'):
+    """
+    选择事件循环，需要在创建事件循环之前调用，多进程模式下worker会继承主进程的设置
+    name为auto时安装了uvloop就使用uvloop，否则使用asyncio默认的事件循环
+    """
+    if name == 'asyncio':
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def run_options():
+    """根据配置生成传给web.run_app的参数"""
+    server = configs.server
+    options = dict(
+        backlog=server.get('backlog', 128),
+        keepalive_timeout=server.get('keepalive_timeout', 75))
+    if not server.get('access_log', True):
+        options['access_log'] = None  # 关闭访问日志
+    elif server.get('access_log_format'):
+        options['access_log_format'] = server.access_log_format
+    return options
+
+
+def run_worker(sock, index):
+    """在worker进程中启动服务，sock为None时使用SO_REUSEPORT自己绑定端口"""
+    server = configs.server
+    if sock is None:
+        web.run_app(init(server.workers), host=server.host, port=server.port, reuse_port=True,
+                    **run_options())
+    else:
+        web.run_app(init(server.workers), sock=sock, **run_options())
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         exit('参数错误')
     arg = sys.argv[1]
     # 先设置os.environ后导入，避免其他文件无法获取到os.environ['app_env']
     os.environ['app_env'] = arg
     from config import configs
+    logging.basicConfig(level=configs.get('logging', {}).get('level', 'INFO'))
     from handlers import COOKIE_NAME, cookie2user
-    web.run_app(init(), host='127.0.0.1', port=9000)  # 启动
-    logging.info('server started at http://127.0.0.1:9000...')
+    if len(sys.argv) == 3:  # 命令行指定的进程数优先于配置文件
+        configs.server.workers = int(sys.argv[2])
+    host, port, workers = configs.server.host, configs.server.port, configs.server.workers
+    loop = install_loop(os.environ.get('app_loop') or configs.server.get('loop', 'auto'))
+    logging.info('server started at http://{}:{} with {} worker(s), {} loop...'.format(
+        host, port, workers, loop))
+    if workers > 1:
+        import prefork
+        prefork.serve(run_worker, workers, host, port,
+                      reuse_port=configs.server.get('reuse_port', False),
+                      backlog=configs.server.get('backlog', 128))
+    else:
+        web.run_app(init(), host=host, port=port, **run_options())  # 启动
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+静态文件指纹：打包时为每个静态文件复制一份带内容hash的文件，如js/awesome.js => js/awesome.1a2b3c4d.js，
+对应关系写入static/manifest.json
+模板中用{{ static('js/awesome.js') }}得到带hash的url，带hash的文件内容不会变，浏览器可以永久缓存
+没有manifest时（开发环境）返回原文件的url
+生成manifest：python3 assets.py [目录]，默认为static目录
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+
+MANIFEST = 'manifest.json'
+URL_PREFIX = '/static/'
+# 带hash的文件的Cache-Control
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_manifest = {}  # 原文件名 => 带hash的文件名
+_hashed = set()  # 所有带hash的文件名
+
+
+def hashed_name(name, data):
+    """在扩展名前插入内容hash：css/uikit.min.css => css/uikit.min.<hash>.css"""
+    base, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.md5(data).hexdigest()[:8], ext)
+
+
+def build_manifest(root):
+    """为root目录下的文件生成带hash的副本和manifest，返回manifest"""
+    old = read_manifest(root)
+    generated = set(old.values())
+    manifest = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            if name == MANIFEST or name in generated or name.endswith(('.gz', '.br')):
+                continue  # 跳过manifest、上次生成的文件和预压缩文件
+            with open(path, 'rb') as f:
+                target = hashed_name(name, f.read())
+            if not os.path.exists(os.path.join(root, target)):
+                shutil.copy2(path, os.path.join(root, target))
+            manifest[name] = target
+    for name in generated - set(manifest.values()):  # 删除内容已经改变的旧文件
+        for suffix in ('', '.gz', '.br'):
+            stale = os.path.join(root, name + suffix)
+            if os.path.exists(stale):
+                os.remove(stale)
+    with open(os.path.join(root, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_manifest(root):
+    """服务启动时加载manifest"""
+    _manifest.clear()
+    _manifest.update(read_manifest(root))
+    _hashed.clear()
+    _hashed.update(_manifest.values())
+    logging.info('loaded {} static assets from manifest'.format(len(_manifest)))
+
+
+def static(name):
+    """返回静态文件的url，manifest中有对应的带hash的文件时使用带hash的文件"""
+    return URL_PREFIX + _manifest.get(name, name)
+
+
+def is_hashed(name):
+    return name in _hashed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static')
+    print('{} assets in manifest'.format(len(build_manifest(root))))
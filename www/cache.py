@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""进程内缓存"""
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    带过期时间的LRU缓存，超过maxsize时淘汰最久未使用的条目
+    cache = LRUCache(maxsize=1000, ttl=60)
+    cache.set('key', 'value')  # 使用默认过期时间
+    cache.set('key', 'value', expires=time.time() + 10)  # 指定过期时间点
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl  # 默认存活秒数，None表示不过期
+        self._data = OrderedDict()  # key => (value, expires)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires is not None and expires < time.time():  # 已过期则删除
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)  # 标记为最近使用
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires=None):
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)  # 淘汰最久未使用的条目
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+响应压缩：动态响应由app中的compress_factory按需压缩，静态文件在打包时预先压缩成.gz/.br文件
+安装了brotli时优先使用br，否则使用gzip
+预压缩静态文件：python3 compress.py [目录]，默认为static目录
+"""
+
+import os
+import sys
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 需要压缩的内容类型，图片、字体(woff)等本身已经压缩过的不处理
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'image/svg+xml', 'application/vnd.ms-fontobject', 'font/ttf', 'font/otf')
+# 预压缩的静态文件扩展名
+STATIC_EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.txt', '.eot', '.ttf', '.otf')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def is_compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """
+    根据Accept-Encoding请求头从encodings中选出客户端支持的编码，按encodings的顺序优先
+    q=0表示客户端不接受该编码，不支持时返回None
+    """
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:].strip('0.') == '':
+            continue  # q=0
+        accepted.add(name.strip())
+    for encoding in encodings or available_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(body, encoding, level=6):
+    """压缩body，level为gzip的压缩级别(1-9)，brotli使用对应的quality"""
+    if encoding == 'br':
+        # brotli的quality为0-11，level为9时使用最高的11，动态响应用较低的level以免压缩本身耗时太多
+        return brotli.compress(body, quality=11 if level >= 9 else level)
+    return gzip.compress(body, compresslevel=level)
+
+
+def precompress(root, min_size=1024):
+    """
+    为root目录下的静态文件生成.gz和.br文件，已是最新的跳过
+    小于min_size或压缩后没有变小的文件不生成，返回生成的文件数
+    """
+    count = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if stat.st_size < min_size:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in available_encodings():
+                target = path + SUFFIXES[encoding]
+                if os.path.exists(target) and os.stat(target).st_mtime >= stat.st_mtime:
+                    continue
+                body = compress(data, encoding, level=9 if encoding == 'gzip' else 11)
+                if len(body) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(body)
+                count += 1
+                logging.info('{} {} => {} bytes'.format(target, len(data), len(body)))
+    return count
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static')
+    if brotli is None:
+        logging.warning('brotli not installed, only generate .gz files')
+    print('{} files compressed'.format(precompress(root)))
@@ -6,12 +6,66 @@ __author__ = 'komorebi'
 """默认配置文件，适用于本地开发环境"""
 
 configs = {
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 1,  # 进程数，大于1时使用多进程模式，也可以通过命令行参数指定
+        'reuse_port': False,  # 多进程时各worker用SO_REUSEPORT绑定端口，否则共享主进程创建的socket
+        'loop': 'auto',  # 事件循环：auto（安装了uvloop就使用）、uvloop、asyncio，也可以用环境变量app_loop指定
+        'backlog': 128,  # 监听队列长度
+        'keepalive_timeout': 75,  # keep-alive连接的空闲超时，单位秒
+        'access_log': True,  # 是否输出aiohttp的访问日志，已有logger_factory的请求日志时可以关闭
+        'access_log_format': None,  # 访问日志格式，None使用aiohttp的默认格式
+        'client_max_size': 1024 ** 2  # 请求体的最大字节数
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'ormuser',
         'password': 'password',
-        'database': 'awesome'
+        'database': 'awesome',
+        'minsize': 1,  # 连接池最小连接数（所有进程合计）
+        'maxsize': 10,  # 连接池最大连接数（所有进程合计）
+        'acquire_timeout': 5,  # 等待空闲连接的最长时间（秒），超时返回503
+        'connect_timeout': 10,  # 建立连接的超时时间（秒）
+        'pool_recycle': 3600,  # 连接使用超过该秒数后重建
+        'count_ttl': 300,  # 表行数缓存的对账间隔（秒）
+        'count_estimate_rows': None,  # 行数超过该值后使用information_schema估算，None表示始终精确计数
+        'replicas': [],  # 从库列表，如[{'host': '10.0.0.2'}]，未写的参数沿用主库配置
+        'balance': 'round_robin'  # 从库选择方式：round_robin 或 least_busy
+    },
+    'session': {
+        'secret': 'AwEsOmE',
+        'max_age': 86400,
+        'cache_size': 10000,  # 会话缓存最多保存的cookie数量
+        'cache_ttl': 120  # 会话缓存的秒数，多进程时其他worker中用户信息修改最迟在该时间后生效
+    },
+    'logging': {
+        'level': 'INFO',  # 全局日志级别
+        'request_level': 'INFO',  # 请求日志的级别，awesome.request日志使用该级别，不受全局级别影响
+        'sample_rate': 1.0,  # 请求日志的采样比例，出错和慢请求总会输出
+        'slow_ms': 1000,  # 超过该毫秒数的请求视为慢请求
+        'max_queries': 20,  # 单个请求的sql超过该条数时输出警告
+        'max_repeats': 5,  # 同一条sql在单个请求中执行超过该次数时输出警告（N+1查询）
+        'server_timing': True  # 是否在响应头中返回Server-Timing
+    },
+    'json_backend': 'auto',  # API返回值的序列化方式：auto、json或orjson
+    'executor': {
+        'kind': 'thread',  # markdown和模板渲染的执行方式：thread、process或none
+        'workers': None,  # 线程或进程数，None使用默认值
+        'min_size': 20000  # 数据量小于该值时直接在事件循环中执行
+    },
+    'templates': {
+        'bytecode_cache_dir': None  # 生产模式下模板字节码缓存目录，None表示使用系统临时目录
+    },
+    'cache': {
+        'markdown_size': 1000,  # 最多缓存多少篇blog渲染后的html
+        'page_enabled': True,  # 是否缓存匿名用户访问的页面
+        'page_size': 1000  # 最多缓存多少个页面
     },
-    'session': {'secret': 'AwEsOmE', 'max_age': 86400}
+    'compress': {
+        'enabled': True,  # 是否压缩html、json等动态响应，静态文件使用打包时生成的.gz/.br文件
+        'min_size': 1024,  # 小于该字节数的响应不压缩
+        'level': 6  # 压缩级别，gzip为1-9，brotli使用相同数值的quality
+    }
 }
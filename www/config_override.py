@@ -10,5 +10,10 @@ configs = {
         "host": '127.0.0.1',
         "user": 'awesome',
         "password": 'password'
+    },
+    'logging': {
+        'level': 'WARNING',
+        'sample_rate': 0.01,
+        'server_timing': False
     }
 }
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+请求上下文：记录当前请求的处理函数、数据库耗时、sql条数和模板渲染耗时，
+并检查重复查询和N+1查询
+由app中的logger_factory在每个请求开始时创建，orm等模块通过current()获取
+"""
+
+import time
+import hashlib
+import contextvars
+
+_current = contextvars.ContextVar('request_context', default=None)
+
+
+class RequestContext(object):
+
+    __slots__ = ('method', 'path', 'handler', 'status', 'start',
+                 'query_count', 'db_time', 'render_time', 'sqls', 'calls')
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.handler = None
+        self.status = None
+        self.start = time.time()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.sqls = {}  # sql => 执行次数
+        self.calls = {}  # (sql, 参数) => 执行次数
+
+    def add_query(self, sql, args, elapsed):
+        """orm每执行一条sql调用一次"""
+        self.query_count += 1
+        self.db_time += elapsed
+        self.sqls[sql] = self.sqls.get(sql, 0) + 1
+        key = (sql, repr(args))
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def check(self, max_queries=20, max_repeats=5):
+        """
+        检查本次请求的查询，返回问题描述列表：
+        sql总数超过max_queries；同一条sql（参数不同）执行超过max_repeats次，通常是N+1查询；
+        sql和参数完全相同的查询执行了多次
+        """
+        problems = []
+        if self.query_count > max_queries:
+            problems.append('{} queries (> {})'.format(self.query_count, max_queries))
+        for sql, n in self.sqls.items():
+            if n > max_repeats:
+                problems.append('possible N+1: {} times: {}'.format(n, sql))
+        for (sql, args), n in self.calls.items():
+            if n > 1:  # 参数可能包含邮箱、密码hash等，日志中只输出参数的hash
+                problems.append('identical query {} times: {} (args md5 {})'.format(
+                    n, sql, hashlib.md5(args.encode('utf-8')).hexdigest()[:8]))
+        return problems
+
+    def server_timing(self):
+        """生成Server-Timing响应头"""
+        return 'db;dur={:.2f};desc="{} queries", render;dur={:.2f}, total;dur={:.2f}'.format(
+            self.db_time * 1000, self.query_count, self.render_time * 1000, self.elapsed() * 1000)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def to_dict(self):
+        return dict(
+            method=self.method,
+            path=self.path,
+            status=self.status,
+            handler=self.handler,
+            duration_ms=round(self.elapsed() * 1000, 2),
+            db_ms=round(self.db_time * 1000, 2),
+            queries=self.query_count,
+            render_ms=round(self.render_time * 1000, 2))
+
+
+def begin(method, path):
+    """创建当前请求的上下文"""
+    ctx = RequestContext(method, path)
+    _current.set(ctx)
+    return ctx
+
+
+def current():
+    """返回当前请求的上下文，不在请求中时返回None"""
+    return _current.get()
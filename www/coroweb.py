@@ -3,7 +3,10 @@
 __author__ = 'komorebi'
 
 import os.path
+import mimetypes
 from apis import APIError
+import compress
+import assets
 from urllib import parse
 from aiohttp import web
 import functools
@@ -11,12 +14,11 @@ import asyncio
 import inspect
 import logging
 
-logging.basicConfig(level=logging.INFO)
 
-
-def get(path):
+def get(path, cache_ttl=None):
     """
     定义装饰器获取URL路径
+    cache_ttl表示匿名访问时页面缓存的秒数，None表示不缓存
     """
     def decorator(func):
         @functools.wraps(func)
@@ -24,6 +26,7 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'  # 给函数添加__method__属性
         wrapper.__route__ = path  # 给函数添加__route__属性
+        wrapper.__cache_ttl__ = cache_ttl  # 给函数添加__cache_ttl__属性
         return wrapper
     return decorator
 
@@ -101,6 +104,7 @@ class RequestHandler(object):
     """
     任何请求都会进入这个类
     将请求的任何参数都变成self._func(**kw)的形式
+    参数的处理方式在__init__中根据函数签名一次性确定（见_compile_binder），请求时只执行必要的步骤
     """
 
     def __init__(self, app, fn):
@@ -111,58 +115,56 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._name_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._cache_ttl = getattr(fn, '__cache_ttl__', None)
+        self._bind = self._compile_binder()
 
-    async def __call__(self, request):
-        kw = None
-        # 如果函数参数存在关键字参数**kw或存在命名关键字参数（定义函数时出现在*或者*args后的参数）或者存在requests参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':  # 请求方式为POST
-                if not request.content_type:  # 如果request未带有content_type则报错
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith(
-                        'application/json'):  # 请求参数示例：{"Name": "John Smith", "Age": 23}
-                    params = await request.json()  # 获取请求参数
-                    if not isinstance(params, dict):  # 请求参数必须为字典
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                # 'application/x-www-form-urlencoded'示例：Name=John+Smith&Age=23；'multipart/form-data'表示文件上传
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(
-                        'Unsupported Content-Type:{}'.format(request.content_type))
-            if request.method == 'GET':
-                qs = request.query_string  # url的参数  比如/?page=2&id=10&name=john
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(
-                            qs, True).items():  # parse.parse_qs解析请求URL的字符串参数并以字典形式返回
-                        kw[k] = v[0]  # 将请求参数组装成dict
-        if kw is None:
-            kw = dict(**request.match_info)  # 从URL获取参数，比如'/blog/{id}' 里面的ID
-        else:  # 走到这里说明kw不为空
-            if not self._has_var_kw_arg and self._name_kw_args:  # 不存在关键词参数但存在命名关键词参数
-                copy = dict()
-                for name in self._name_kw_args:  # 如果request中的命名关键词参数在kw中，则将kw该key的值覆盖copy中该key的值，即参数的值以kw为准
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            for k, v in request.match_info.items():
-                if k in kw:  # 当出现重复参数，只给予警告信息
-                    logging.warning(
-                        'Duplicate arg name in named arg and kw args:{}'.format(K))
-                kw[k] = v
-        # 如果函数有requests参数，则赋值给kw['request'] = request
-        if self._has_request_arg:
-            kw['request'] = request
-        if self._required_kw_args:
-            for name in self._required_kw_args:
+    def _compile_binder(self):
+        """
+        根据函数签名生成参数绑定函数bind(request)，返回调用函数用的kw，参数有误时返回错误响应
+        """
+        has_request_arg = self._has_request_arg
+        required = self._required_kw_args
+        # 不存在关键词参数但存在命名关键词参数时，只保留命名关键词参数
+        only_named = None if self._has_var_kw_arg or not self._name_kw_args else self._name_kw_args
+
+        if not (self._has_var_kw_arg or self._has_named_kw_args or required):
+            # 函数不需要请求参数，只从URL获取参数，比如'/blog/{id}' 里面的ID
+            async def bind(request):
+                kw = dict(request.match_info)
+                if has_request_arg:
+                    kw['request'] = request
+                return kw
+            return bind
+
+        async def bind(request):
+            kw = await read_params(request)
+            if isinstance(kw, web.StreamResponse):  # 请求参数有误
+                return kw
+            if kw is None:
+                kw = dict(request.match_info)
+            else:
+                if only_named is not None:
+                    kw = {name: kw[name] for name in only_named if name in kw}
+                for k, v in request.match_info.items():
+                    if k in kw:  # 当出现重复参数，只给予警告信息
+                        logging.warning(
+                            'Duplicate arg name in named arg and kw args:{}'.format(k))
+                    kw[k] = v
+            # 如果函数有requests参数，则赋值给kw['request'] = request
+            if has_request_arg:
+                kw['request'] = request
+            for name in required:
                 if name not in kw:  # 如果请求参数中少传了参数则报错
                     return web.HTTPBadRequest(
-                        'Missing argument:{}'.format(name))
-        logging.info('call with args:{}'.format(str(kw)))
+                        text='Missing argument:{}'.format(name))
+            return kw
+        return bind
+
+    async def __call__(self, request):
+        kw = await self._bind(request)
+        if isinstance(kw, web.StreamResponse):
+            return kw
+        logging.debug('call with args: %s', kw)
         try:
             r = await self._func(**kw)
             return r
@@ -170,13 +172,92 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 
+async def read_params(request):
+    """
+    读取POST请求体或GET查询字符串中的参数，返回dict；
+    没有参数时返回None，请求格式有误时返回错误响应
+    """
+    if request.method == 'POST':  # 请求方式为POST
+        if not request.content_type:  # 如果request未带有content_type则报错
+            return web.HTTPBadRequest(text='Missing Content-Type.')
+        ct = request.content_type.lower()
+        if ct.startswith(
+                'application/json'):  # 请求参数示例：{"Name": "John Smith", "Age": 23}
+            params = await request.json()  # 获取请求参数
+            if not isinstance(params, dict):  # 请求参数必须为字典
+                return web.HTTPBadRequest(text='JSON body must be object.')
+            return params
+        # 'application/x-www-form-urlencoded'示例：Name=John+Smith&Age=23；'multipart/form-data'表示文件上传
+        if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+            params = await request.post()
+            return dict(**params)
+        return web.HTTPBadRequest(
+            text='Unsupported Content-Type:{}'.format(request.content_type))
+    if request.method == 'GET':
+        qs = request.query_string  # url的参数  比如/?page=2&id=10&name=john
+        if qs:
+            # parse.parse_qs解析请求URL的字符串参数并以字典形式返回，将请求参数组装成dict
+            return {k: v[0] for k, v in parse.parse_qs(qs, True).items()}
+    return None
+
+
+def invalidate_pages(app, *paths):
+    """清除指定路径的页面缓存（包括带查询参数的页面），供写操作的handler调用"""
+    cache = app.get('__page_cache__')
+    if cache is None:
+        return
+    for key in cache.keys():
+        if any(key == p or key.startswith(p + '?') for p in paths):
+            cache.pop(key)
+
+
+class StaticHandler(object):
+    """
+    静态文件处理函数，客户端支持时返回打包时预先生成的.br/.gz文件（见compress.py），
+    manifest中带hash的文件（见assets.py）返回永久缓存的Cache-Control
+    """
+
+    def __init__(self, root):
+        self._root = os.path.realpath(root)
+
+    def _resolve(self, filename, accept_encoding):
+        """查找要返回的文件和响应头，文件不存在时返回None，会访问文件系统，在线程池中执行"""
+        path = os.path.realpath(os.path.join(self._root, filename))
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            return None  # 不存在或在静态资源目录之外
+        headers = {}
+        if assets.is_hashed(filename):  # 带hash的文件内容不会变，浏览器不需要再验证
+            headers['Cache-Control'] = assets.IMMUTABLE
+        content_type = mimetypes.guess_type(path)[0]
+        if compress.is_compressible(content_type):
+            headers['Vary'] = 'Accept-Encoding'
+            # 预压缩文件直接返回，不需要安装brotli
+            encodings = [e for e in ('br', 'gzip') if os.path.isfile(path + compress.SUFFIXES[e])]
+            encoding = compress.choose_encoding(accept_encoding, encodings) if encodings else None
+            if encoding is not None:
+                headers['Content-Type'] = content_type
+                headers['Content-Encoding'] = encoding
+                path += compress.SUFFIXES[encoding]
+        return path, headers
+
+    async def __call__(self, request):
+        found = await asyncio.get_running_loop().run_in_executor(
+            None, self._resolve, request.match_info['filename'],
+            request.headers.get('Accept-Encoding'))
+        if found is None:
+            raise web.HTTPNotFound()
+        path, headers = found
+        return web.FileResponse(path, headers=headers)
+
+
 def add_static(app):
     """添加静态资源"""
     path = os.path.join(
         os.path.dirname(
             os.path.abspath(__file__)),
         'static')  # 获取静态资源目录
-    app.router.add_static('/static/', path)  # 添加静态资源
+    assets.load_manifest(path)  # 模板中static()使用的带hash的文件名
+    app.router.add_get('/static/{filename:.+}', StaticHandler(path), allow_head=True)  # 添加静态资源
     logging.info('add static {} => {}'.format('/static/', path))
 
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+把耗CPU的操作（markdown渲染、模板渲染等）放到线程池或进程池中执行，避免阻塞事件循环
+html = await run_cpu(markdown2.markdown, content, size=len(content))
+size小于min_size时直接在当前线程执行，因为放到线程池的开销比执行本身还大
+"""
+
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+_options = dict(kind='thread', workers=None, min_size=20000)
+_pools = {}  # kind => executor，第一次使用时创建
+
+
+def init_executor(kind='thread', workers=None, min_size=20000):
+    """
+    kind为thread、process或none（全部在事件循环中执行）
+    进程池只能执行可以pickle的函数，其他函数会改用线程池
+    """
+    if kind not in ('thread', 'process', 'none'):
+        raise ValueError('Invalid executor kind: {}'.format(kind))
+    _options.update(kind=kind, workers=workers, min_size=min_size)
+    logging.info('cpu executor: {} (workers: {}, min_size: {})'.format(kind, workers, min_size))
+
+
+def _pool(kind):
+    pool = _pools.get(kind)
+    if pool is None:
+        if kind == 'process':
+            pool = ProcessPoolExecutor(max_workers=_options['workers'])
+        else:
+            pool = ThreadPoolExecutor(max_workers=_options['workers'], thread_name_prefix='cpu')
+        _pools[kind] = pool
+    return pool
+
+
+async def run_cpu(fn, *args, size=None, picklable=True, **kw):
+    """
+    执行fn(*args, **kw)并返回结果
+    size为本次处理的数据量，None表示总是放到执行器中；picklable为False时不使用进程池
+    """
+    kind = _options['kind']
+    if kind == 'none' or (size is not None and size < _options['min_size']):
+        return fn(*args, **kw)
+    if kind == 'process' and not picklable:
+        kind = 'thread'
+    return await asyncio.get_running_loop().run_in_executor(
+        _pool(kind), functools.partial(fn, *args, **kw))
+
+
+def shutdown():
+    for pool in _pools.values():
+        pool.shutdown(wait=False)
+    _pools.clear()
@@ -5,29 +5,34 @@ __author__ = 'komorebi'
 
 import hashlib
 
-from coroweb import get, post
+from coroweb import get, post, invalidate_pages
 from models import User, Blog, next_id, Comment
+from orm import (create_args_string, gather, transaction, pool_stats, query_cache_stats,
+                 count_cache_stats, PoolTimeoutError)
 import time
 import re
 import json
 import hashlib
 import logging
 import markdown2
-from apis import APIValueError, APIError, APIPermissionError, Page, APIResourceNotFoundError
+from apis import APIValueError, APIError, APIPermissionError, Page, APIResourceNotFoundError, CursorPage, decode_cursor
 from aiohttp import web
 from config import configs
+from cache import LRUCache
+from executor import run_cpu
 
 
-@get('/')
+@get('/', cache_ttl=30)
 async def index(*, page='1'):
     """首页"""
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')  # 查询blog总数
-    page = Page(num)
+    num = await Blog.countAll()  # 查询blog总数
+    page = Page(num, page_index)
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit),
+                                   defer=('content',), compact=True)  # 列表页不需要正文
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -36,16 +41,18 @@ async def index(*, page='1'):
 
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
-    """获取所有user"""
+async def api_get_users(*, page='1', cursor=None):
+    """获取所有user，不查询passwd列"""
+    if cursor is not None:
+        p, users = await find_cursor_page(User, cursor, fields=_USER_PUBLIC_FIELDS)
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')  # 查询user总数
+    num = await User.countAll()  # 查询user总数
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc')
-    for u in users:
-        u.passwd = '******'
+    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit),
+                               fields=_USER_PUBLIC_FIELDS)
     return dict(page=p, users=users)
 
 
@@ -53,8 +60,16 @@ _RE_EMAIL = re.compile(
     r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 COOKIE_NAME = 'awesession'
+_USER_PUBLIC_FIELDS = tuple(f for f in User.__fields__ if f != 'passwd')  # 可以返回给前端的user字段
 _COOKIE_KEY = configs.session.secret
 max_age_limit = configs.session.max_age
+# 会话缓存的时间，invalidate_user_sessions只能清除当前进程的缓存，
+# 其他worker中被降权、删除或修改密码的用户最迟在该时间后失效
+_session_cache_ttl = min(configs.session.get('cache_ttl', 120), max_age_limit)
+# cookie => user的会话缓存，避免每个请求都查询users表
+_session_cache = LRUCache(
+    maxsize=configs.session.get('cache_size', 10000),
+    ttl=_session_cache_ttl)
 
 
 @post('/api/users')  # register.html调用了该接口
@@ -91,7 +106,7 @@ async def api_register_user(*, email, name, passwd):
     user.passwd = '******'
     r.content_type = 'application/json'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
-    logging.info("user information >>>>", user)
+    logging.debug('user registered: %s', user.email)
     return r
 
 
@@ -115,11 +130,13 @@ async def signout(request):
     # 告诉服务器该网页是从哪个页面链接过来的，服务器因此可以获得一些信息用于处理。
     cookie_str = request.cookies.get(COOKIE_NAME)
     user = await cookie2user(cookie_str)
+    _session_cache.pop(cookie_str)  # 退出登录后该cookie不再有效
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')  # 返回到来源页或者首页
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0,
                  httponly=True)  # max_age=0让cookie立马失效
-    logging.info('user {} signed out.'.format(user.name))
+    if user:
+        logging.info('user {} signed out.'.format(user.name))
     return r
 
 
@@ -165,10 +182,26 @@ def user2cookie(user, max_age):
     return '-'.join(L)
 
 
+def invalidate_user_sessions(uid):
+    """用户信息修改或删除后调用，清除该用户所有已缓存的会话，uid为None时清除全部"""
+    if uid is None:
+        _session_cache.clear()
+        return
+    for key in _session_cache.keys():
+        if key.startswith('{}-'.format(uid)):
+            _session_cache.pop(key)
+
+
+User.__on_change__.append(invalidate_user_sessions)  # User.update()/remove()等修改users表后调用
+
+
 async def cookie2user(cookie_str):
-    """根据cookie找user"""
+    """根据cookie找user，优先从会话缓存中获取"""
     if not cookie_str:
         return None
+    cached = _session_cache.get(cookie_str)
+    if cached is not None:
+        return User(**cached)  # 返回副本，避免handler修改缓存中的数据
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -184,7 +217,13 @@ async def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'  # 将用户密码返回给前端时隐藏处理
+        # 缓存到cookie过期时间、max_age和cache_ttl中最早的时间点
+        now = time.time()
+        _session_cache.set(cookie_str, User(**user), expires=min(
+            int(expires), now + max_age_limit, now + _session_cache_ttl))
         return user
+    except PoolTimeoutError:  # 连接池耗尽时由response_factory返回503，不能当作匿名用户
+        raise
     except Exception as e:
         logging.exception(e)
         return None
@@ -208,6 +247,30 @@ def get_page_index(page_str):
     return p
 
 
+async def find_cursor_page(model, cursor, where=None, args=None, page_size=10,
+                           fields=None, defer=None, compact=False):
+    """
+    游标分页查询，cursor为空字符串时返回第一页
+    返回(CursorPage, 数据列表)
+    """
+    after = before = None
+    if cursor:
+        direction, key = decode_cursor(cursor)
+        if direction == 'prev':
+            before = key
+        else:
+            after = key
+    items, has_more = await model.findByCursor(
+        where, args, after=after, before=before, limit=page_size,
+        fields=fields, defer=defer, compact=compact)
+    if before is not None:
+        p = CursorPage(items, page_size, has_next=True, has_previous=has_more)
+    else:
+        p = CursorPage(items, page_size, has_next=has_more,
+                       has_previous=after is not None)
+    return p, items
+
+
 def text2html(text):
     """将一些字符转义"""
     lines = map(
@@ -220,22 +283,50 @@ def text2html(text):
     return ''.join(lines)
 
 
-@get('/blog/{id}')
-async def get_blog(id):
-    """根据id获取blog及其评论"""
-    blog = await Blog.find(id)
-    comments = await Comment.findAll(
-        'blog_id=?',
-        [id],
-        orderBy='created_at desc'
-    )
+_COMMENT_PAGE_SIZE = 20  # blog页面每页显示的评论数
+
+# (blog id, 正文md5) => 渲染后的html
+_markdown_cache = LRUCache(maxsize=configs.get('cache', {}).get('markdown_size', 1000))
+
+
+async def blog2html(blog):
+    """将blog正文渲染成html，结果按blog id和正文hash缓存，长文在执行器中渲染"""
+    key = (blog.id, hashlib.md5(blog.content.encode('utf-8')).hexdigest())
+    html = _markdown_cache.get(key)
+    if html is None:
+        html = await run_cpu(markdown2.markdown, blog.content, size=len(blog.content))
+        _markdown_cache.set(key, html)
+    return html
+
+
+def invalidate_blog_html(blog_id):
+    """blog被修改或删除后清除其渲染缓存"""
+    for key in _markdown_cache.keys():
+        if key[0] == blog_id:
+            _markdown_cache.pop(key)
+
+
+@get('/blog/{id}', cache_ttl=60)
+async def get_blog(id, *, page='1'):
+    """根据id获取blog及其评论，评论分页显示"""
+    page_index = get_page_index(page)
+    offset = (page_index - 1) * _COMMENT_PAGE_SIZE
+    # blog、当页评论和评论总数三个查询并发执行
+    blog, num = await gather(
+        Blog.find(id, include={'comments': dict(limit=(offset, _COMMENT_PAGE_SIZE))}),
+        Comment.findNumber('count(id)', 'blog_id=?', [id]))
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    p = Page(num or 0, page_index, _COMMENT_PAGE_SIZE)
+    comments = blog.comments if p.limit else []
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)  # 让blog支持markdown
+    blog.html_content = await blog2html(blog)  # 让blog支持markdown
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'page': p
     }
 
 
@@ -262,6 +353,8 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    invalidate_blog_html(id)
+    invalidate_pages(request.app, '/', '/blog/{}'.format(id))
     return dict(id=id)
 
 
@@ -288,6 +381,7 @@ async def api_create_blog(request, *, name, summary, content):
         summary=summary.strip(),
         content=content.strip())
     await blog.save()
+    invalidate_pages(request.app, '/')
     return blog
 
 
@@ -305,17 +399,23 @@ async def api_edit_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    invalidate_blog_html(id)
+    invalidate_pages(request.app, '/', '/blog/{}'.format(id))
     return blog
 
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:  # 游标分页模式
+        p, blogs = await find_cursor_page(Blog, cursor, defer=('content',))
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')  # 获取blog总数
+    num = await Blog.countAll()  # 获取blog总数
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit),
+                               defer=('content',))  # 列表页不需要正文
     return dict(page=p, blogs=blogs)
 
 
@@ -349,9 +449,12 @@ async def manage_users(*, page='1'):
 
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:  # 游标分页模式
+        p, comments = await find_cursor_page(Comment, cursor)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
+    num = await Comment.countAll()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
@@ -366,16 +469,18 @@ async def api_create_comment(id, request, *, content):
         raise APIPermissionError('please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = await Blog.find(id)
-    if blog is None:
-        raise APIResourceNotFoundError('Blog')
-    comment = Comment(
-        blog_id=blog.id,
-        user_id=user.id,
-        user_name=user.name,
-        user_image=user.image,
-        content=content.strip())
-    await comment.save()
+    async with transaction():  # 校验blog存在与保存评论使用同一个连接，一次提交
+        blog = await Blog.find(id)
+        if blog is None:
+            raise APIResourceNotFoundError('Blog')
+        comment = Comment(
+            blog_id=blog.id,
+            user_id=user.id,
+            user_name=user.name,
+            user_image=user.image,
+            content=content.strip())
+        await comment.save()
+    invalidate_pages(request.app, '/blog/{}'.format(blog.id))
     return comment
 
 
@@ -386,4 +491,32 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    invalidate_pages(request.app, '/blog/{}'.format(c.blog_id))
     return dict(id=id)
+
+
+@post('/api/comments/delete')
+async def api_delete_comments_batch(request, *, ids):
+    """批量删除评论，ids为评论id列表或以逗号分隔的字符串"""
+    check_admin(request)
+    if isinstance(ids, str):
+        ids = [i for i in ids.split(',') if i.strip()]
+    if not ids or not isinstance(ids, list):
+        raise APIValueError('ids')
+    where = 'id in ({})'.format(create_args_string(len(ids)))
+    comments = await Comment.findAll(where, ids, fields=('blog_id',))
+    rows = await Comment.delete_where(where, ids)
+    invalidate_pages(request.app, *set('/blog/{}'.format(c.blog_id) for c in comments))
+    return dict(ids=ids, deleted=rows)
+
+
+@get('/api/metrics')
+async def api_metrics(request):
+    """连接池、sql耗时和各类缓存的运行指标"""
+    check_admin(request)
+    return dict(
+        pool=pool_stats(),
+        query_cache=query_cache_stats(),
+        counts=count_cache_stats(),
+        session_cache=_session_cache.stats(),
+        markdown_cache=_markdown_cache.stats())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""运行指标统计"""
+
+import bisect
+
+# 默认的耗时分桶上限（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram(object):
+    """
+    直方图，记录落在每个分桶内的次数，以及总次数和总和
+    h = Histogram()
+    h.observe(0.003)
+    h.to_dict()  # {'count': 1, 'sum': 0.003, 'buckets': {'0.001': 0, '0.005': 1, ...}}
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个桶记录超过上限的次数
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        buckets = {str(b): c for b, c in zip(self.buckets, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return dict(count=self.count, sum=round(self.sum, 6), buckets=buckets)
@@ -6,7 +6,7 @@ __author__ = 'komorebi'
 import time
 import uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, HasMany
 
 
 def next_id():
@@ -19,12 +19,40 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(50)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+
+    # 用户信息修改或删除后调用的函数，参数为用户id，批量修改时为None，由handlers注册用于清除会话缓存
+    __on_change__ = []
+
+    @classmethod
+    def _changed(cls, uid):
+        for fn in cls.__on_change__:
+            fn(uid)
+
+    async def update(self):
+        await super().update()
+        self._changed(self.id)
+
+    async def remove(self):
+        await super().remove()
+        self._changed(self.id)
+
+    @classmethod
+    async def update_all(cls, where, values, args=None):
+        rows = await super().update_all(where, values, args)
+        cls._changed(None)
+        return rows
+
+    @classmethod
+    async def delete_where(cls, where, args=None):
+        rows = await super().delete_where(where, args)
+        cls._changed(None)
+        return rows
 
 
 class Blog(Model):
@@ -37,11 +65,13 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
 
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at')]  # 查询某篇blog的评论并按时间排序
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -49,4 +79,4 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    created_at = FloatField(default=time.time, index=True)
\ No newline at end of file
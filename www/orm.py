@@ -1,24 +1,89 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
 import asyncio
+import contextlib
+import contextvars
 import aiomysql  # MySQL的Python异步驱动程序aiomysql
+from metrics import Histogram
+import context
 __author__ = 'komorebi'
 
 import logging
 
-logging.basicConfig(level=logging.INFO)
-
 
 def log(sql, args=()):
-    # 定义函数打印sql
-    logging.info('SQL: {}\r\n ARGS:{}'.format(sql, args))
+    # 定义函数打印sql，只在DEBUG级别输出
+    logging.debug('SQL: %s\r\n ARGS:%s', sql, args)
 
 
-async def create_pool(**kw):
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(  # 建立数据库连接
+_QUERY_CACHE_SIZE = 4096  # 编译缓存最多保存的sql条数
+_driver_sql = {}  # 原始sql => 驱动可直接执行的sql（?已替换成%s）
+_query_cache = {}  # (model, where, orderBy, limit形式) => findAll的sql
+_query_stats = dict(hits=0, misses=0, driver_hits=0, driver_misses=0)
+
+
+def to_driver_sql(sql):
+    """将sql中的占位符?替换成aiomysql使用的%s，结果会被缓存"""
+    try:
+        r = _driver_sql[sql]
+        _query_stats['driver_hits'] += 1
+        return r
+    except KeyError:
+        _query_stats['driver_misses'] += 1
+    if len(_driver_sql) >= _QUERY_CACHE_SIZE:
+        _driver_sql.clear()
+    r = _driver_sql[sql] = sql.replace('?', '%s')
+    return r
+
+
+def cached_query(key, build):
+    """按key缓存拼接好的sql，未命中时调用build()生成"""
+    sql = _query_cache.get(key)
+    if sql is not None:
+        _query_stats['hits'] += 1
+        return sql
+    _query_stats['misses'] += 1
+    if len(_query_cache) >= _QUERY_CACHE_SIZE:
+        _query_cache.clear()
+    sql = _query_cache[key] = build()
+    to_driver_sql(sql)  # 同时完成占位符转换
+    return sql
+
+
+def query_cache_stats():
+    """查询编译缓存的命中情况"""
+    return dict(_query_stats, size=len(_query_cache),
+                driver_size=len(_driver_sql))
+
+
+_counts = {}  # 表名 => [行数, 上次与数据库对账的时间]
+_count_options = dict(ttl=300, estimate_rows=None)
+
+
+def count_cache_stats():
+    """计数缓存中各表当前的行数"""
+    return {table: c[0] for table, c in _counts.items()}
+
+
+# 事务中的计数变化(表名, 增量)，提交后才应用到计数缓存，回滚时丢弃
+_pending_counts = contextvars.ContextVar('pending_counts', default=None)
+
+
+def _adjust_count(table, delta):
+    """save/remove成功后增量维护计数缓存，事务中等到提交后再维护"""
+    pending = _pending_counts.get()
+    if pending is not None:
+        pending.append((table, delta))
+        return
+    c = _counts.get(table)
+    if c is not None:
+        c[0] = max(c[0] + delta, 0)
+
+
+async def _create_pool(kw):
+    return await aiomysql.create_pool(  # 建立数据库连接
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -27,34 +92,205 @@ async def create_pool(**kw):
         charset=kw.get('charset', 'utf8'),  # 注意此处是utf8而不是utf-8
         autocommit=kw.get('autocommit', True),
         maxsize=kw.get('maxsize', 10),  # 连接池最大值
-        minsize=kw.get('minsize', 1)  # 连接池最小值
+        minsize=kw.get('minsize', 1),  # 连接池最小值
+        connect_timeout=kw.get('connect_timeout', 10),  # 建立连接的超时时间（秒）
+        pool_recycle=kw.get('pool_recycle', 3600)  # 连接使用超过该秒数后重建，-1表示不重建
     )
 
 
-async def select(sql, args, size=None):  # size指最多返回多少条
-    """查询使用"""
+async def create_pool(**kw):
+    """
+    创建主库连接池，replicas为从库配置列表，每项未写的参数沿用主库的配置
+    create_pool(host='db1', user='u', password='p', db='awesome',
+                replicas=[dict(host='db2'), dict(host='db3')], balance='least_busy')
+    """
+    logging.info('create database connection pool...')
+    global __pool, __replicas
+    # 计数缓存对账间隔（秒），以及行数超过多少后改用information_schema估算
+    _count_options['ttl'] = kw.get('count_ttl', 300)
+    _count_options['estimate_rows'] = kw.get('count_estimate_rows', None)
+    _replica_options['balance'] = kw.get('balance', 'round_robin')
+    _pool_options['acquire_timeout'] = kw.get('acquire_timeout', 5)
+    __pool = await _create_pool(kw)
+    __replicas = []
+    for replica in kw.get('replicas', None) or []:
+        logging.info('create replica connection pool: {}'.format(replica.get('host')))
+        __replicas.append(await _create_pool(dict(kw, **replica)))
+
+
+__replicas = []  # 从库连接池
+_replica_options = dict(balance='round_robin', next=0)
+# 当前请求是否已经写过主库，写过之后的查询也走主库，保证能读到自己写入的数据
+# 值为请求内共享的dict而不是bool：gather()创建的子task复制的是上下文，
+# 在子task中set()对请求不可见，修改同一个dict则可见
+_wrote_primary = contextvars.ContextVar('wrote_primary', default=None)
+
+
+def start_request():
+    """每个请求开始时调用，重置读写分离的状态"""
+    _wrote_primary.set(dict(wrote=False))
+
+
+def _mark_wrote_primary():
+    state = _wrote_primary.get()
+    if state is None:  # 不在请求中（如脚本），只对当前task生效
+        _wrote_primary.set(dict(wrote=True))
+    else:
+        state['wrote'] = True
+
+
+def _read_pool():
+    """选择一个从库连接池，没有从库或本请求已写过主库时返回主库"""
+    state = _wrote_primary.get()
+    if not __replicas or (state is not None and state['wrote']):
+        return __pool
+    if _replica_options['balance'] == 'least_busy':  # 使用中连接最少的从库
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    i = _replica_options['next'] % len(__replicas)  # 轮询
+    _replica_options['next'] = i + 1
+    return __replicas[i]
+
+
+class PoolTimeoutError(Exception):
+    """在acquire_timeout内没有从连接池获取到连接"""
+    pass
+
+
+_pool_options = dict(acquire_timeout=5)
+_pool_metrics = dict(
+    acquire_timeouts=0,
+    acquire_wait=Histogram(),  # 获取连接的等待时间
+    query_latency=Histogram())  # 每条sql的执行时间
+
+
+async def _acquire(pool):
+    """从连接池获取连接，超时抛出PoolTimeoutError"""
+    start = time.time()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), _pool_options['acquire_timeout'])
+    except asyncio.TimeoutError:
+        _pool_metrics['acquire_timeouts'] += 1
+        raise PoolTimeoutError('no database connection available in {}s'.format(
+            _pool_options['acquire_timeout']))
+    _pool_metrics['acquire_wait'].observe(time.time() - start)
+    return conn
+
+
+async def _execute(cur, sql, args):
+    """执行sql并记录耗时"""
+    start = time.time()
+    await cur.execute(to_driver_sql(sql), args)
+    elapsed = time.time() - start
+    _pool_metrics['query_latency'].observe(elapsed)
+    ctx = context.current()
+    if ctx is not None:  # 记录到当前请求
+        ctx.add_query(sql, args, elapsed)
+
+
+def _pool_stats(pool):
+    return dict(size=pool.size, in_use=pool.size - pool.freesize, idle=pool.freesize,
+                minsize=pool.minsize, maxsize=pool.maxsize)
+
+
+def pool_stats():
+    """连接池使用情况、获取连接等待时间和sql执行时间"""
+    return dict(
+        primary=_pool_stats(__pool),
+        replicas=[_pool_stats(p) for p in __replicas],
+        acquire_timeouts=_pool_metrics['acquire_timeouts'],
+        acquire_wait=_pool_metrics['acquire_wait'].to_dict(),
+        query_latency=_pool_metrics['query_latency'].to_dict())
+
+
+_transaction_conn = contextvars.ContextVar('transaction_conn', default=None)
+
+
+@contextlib.asynccontextmanager
+async def connection(readonly=False):
+    """
+    获取数据库连接：在transaction()中时返回事务固定的连接，
+    否则只读查询从从库获取，写操作从主库获取
+    """
+    conn = _transaction_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    if readonly:
+        pool = _read_pool()
+    else:
+        pool = __pool
+        _mark_wrote_primary()
+    conn = await _acquire(pool)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    """
+    事务：代码块中的select/execute都使用同一个连接，正常结束时提交一次，出现异常则回滚
+    async with orm.transaction():
+        await blog.update()
+        await comment.save()
+    嵌套使用时并入外层事务
+    """
+    if _transaction_conn.get() is not None:
+        yield _transaction_conn.get()
+        return
+    _mark_wrote_primary()
+    conn = await _acquire(__pool)
+    try:
+        await conn.begin()
+        token = _transaction_conn.set(conn)
+        pending = []
+        counts_token = _pending_counts.set(pending)
+        try:
+            yield conn
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()  # 未提交的计数变化随pending一起丢弃
+            raise
+        finally:
+            _pending_counts.reset(counts_token)
+            _transaction_conn.reset(token)
+        for table, delta in pending:  # 提交后其他请求才能看到这些行
+            _adjust_count(table, delta)
+    finally:
+        __pool.release(conn)
+
+
+async def gather(*aws):
+    """并发执行多个查询；事务中只有一个连接，改为依次执行"""
+    if _transaction_conn.get() is not None:
+        return [await aw for aw in aws]
+    return await asyncio.gather(*aws)
+
+
+async def select(sql, args, size=None, tuples=False):  # size指最多返回多少条
+    """查询使用，tuples为True时每行以tuple返回，否则以dict返回"""
     log(sql, args)
-    global __pool
-    with (await __pool) as conn:  # with语句用于自动处理异常
-        cur = await conn.cursor(aiomysql.DictCursor)  # 使用游标
-        # sql.replace('?', '%s')将sql中的占位符?替换成%s
-        await cur.execute(sql.replace('?', '%s'), args or ())
+    async with connection(readonly=True) as conn:  # 事务中使用事务的连接，否则从从库获取
+        cur = await (conn.cursor() if tuples else conn.cursor(aiomysql.DictCursor))  # 使用游标
+        # 将sql中的占位符?替换成%s后执行
+        await _execute(cur, sql, args or ())
         if size:
             rs = await cur.fetchmany(size)  # 返回size条数的记录
         else:
             rs = await cur.fetchall()  # 返回查询结果所有记录
         await cur.close()  # 关闭游标
-        logging.info('rows returned: {}'.format(len(rs)))  # 记录返回行数
+        logging.debug('rows returned: %s', len(rs))  # 记录返回行数
         return rs  # 返回查询结果
 
 
 async def execute(sql, args):
     """新增，删除，修改使用"""
     log(sql, args)
-    with (await __pool) as conn:
+    async with connection() as conn:
         try:
             cur = await conn.cursor()  # 游标
-            await cur.execute(sql.replace('?', '%s'), args)  # 执行sql
+            await _execute(cur, sql, args)  # 执行sql
             affected = cur.rowcount  # 受影响行数
             await cur.close()  # 关闭游标
         except BaseException as e:
@@ -62,6 +298,24 @@ async def execute(sql, args):
         return affected  # 返回受影响行数
 
 
+async def execute_many(statements):
+    """
+    在同一个连接上依次执行多条sql，用于批量操作
+    statements为[(sql, args), ...]，返回受影响的总行数
+    """
+    affected = 0
+    async with connection() as conn:
+        cur = await conn.cursor()
+        try:
+            for sql, args in statements:
+                log(sql, args)
+                await _execute(cur, sql, args)
+                affected += cur.rowcount
+        finally:
+            await cur.close()
+    return affected
+
+
 def create_args_string(n):
     """生成指定长度的?数组，？作为mysql占位符"""
     result = []
@@ -70,6 +324,58 @@ def create_args_string(n):
     return ','.join(result)
 
 
+_models = {}  # 类名 => 模型类
+
+
+class Record(object):
+    """
+    紧凑的只读记录，由tuple游标的结果直接生成，不经过dict
+    支持r.name和r['name']两种取值方式，可通过to_dict()转成dict
+    """
+    __slots__ = ()
+    __columns__ = ()  # 有值的列，只查询部分列时由_for_columns()生成对应的子类
+
+    @classmethod
+    def _for_columns(cls, columns):
+        """返回只包含columns这些列的Record类，按列组合缓存，序列化时不需要逐列判断是否有值"""
+        if columns == cls.__columns__:
+            return cls
+        variant = cls.__variants__.get(columns)
+        if variant is None:
+            variant = type(cls.__name__, (cls,), dict(__slots__=(), __columns__=columns))
+            cls.__variants__[columns] = variant
+        return variant
+
+    @classmethod
+    def _make(cls, columns, row):
+        """columns需要与cls.__columns__一致"""
+        r = cls.__new__(cls)
+        for k, v in zip(columns, row):
+            object.__setattr__(r, k, v)
+        return r
+
+    def __setattr__(self, key, value):
+        raise AttributeError('{} is read-only'.format(self.__class__.__name__))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self.__columns__)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.keys()}
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.to_dict())
+
+
 class ModelMetaclass(type):
     """类名以Metaclass则表示为元类，创建元类继承自type"""
 
@@ -104,6 +410,11 @@ class ModelMetaclass(type):
             raise RuntimeError('Primary key not found.')
         for k in mappings.keys():  # 由于前面已经attrs中属于Field的属性的转移到了attrs.__mappings__中，所以这里移除attrs中这些属性
             attrs.pop(k)
+        # 一对多关系，如Blog.comments = HasMany('Comment', 'blog_id')
+        relations = {k: v for k, v in attrs.items() if isinstance(v, HasMany)}
+        for k in relations.keys():
+            attrs.pop(k)
+        attrs['__relations__'] = relations
         # fields = {'a':1,"b":2,'c':3},则escaped_fields=['`a`', '`b`',
         # '`c`'],等同于['`{}`'.format(i) for i in fields]
         escaped_fields = list(map(lambda f: '`{}`'.format(f), fields))
@@ -111,6 +422,17 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName  # 保存表名
         attrs['__primary_key__'] = primaryKey  # 保存主键
         attrs['__fields__'] = fields  # 保存除主键外的其他列
+        # 保存索引 [(索引名, 列, 是否唯一)]，来自字段的index/unique以及类属性__indexes__中的联合索引
+        indexes = []
+        for k in fields:
+            f = mappings[k]
+            if f.unique or f.index:
+                indexes.append(((f.name or k,), f.unique))
+        for columns in attrs.get('__indexes__', ()):
+            indexes.append((tuple(columns), False))
+        attrs['__indexes__'] = [
+            ('{}_{}_{}'.format('uniq' if unique else 'idx', tableName, '_'.join(columns)), columns, unique)
+            for columns, unique in indexes]
         # 构造增删改查sql语句
         attrs['__select__'] = 'select {}, {} from {}'.format(
             primaryKey, ','.join(escaped_fields), tableName)
@@ -127,7 +449,16 @@ class ModelMetaclass(type):
             primaryKey)  # 这里的lambda等同于['`{}`=?'.format(i) for i in fields]
         attrs['__delete__'] = 'delete from `{}` where `{}`=?'.format(
             tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)  # 创建类，此时的attrs已经有了很大的改动
+        # 静态sql在建类时就完成占位符转换
+        for k in ('__select__', '__insert__', '__update__', '__delete__'):
+            to_driver_sql(attrs[k])
+        model = type.__new__(cls, name, bases, attrs)  # 创建类，此时的attrs已经有了很大的改动
+        # 紧凑的只读记录类，列作为__slots__，用于findAll(compact=True)
+        columns = tuple([primaryKey] + fields)
+        model.__record__ = type('{}Record'.format(name), (Record,), dict(
+            __slots__=columns, __columns__=columns, __variants__={}, __model__=model))
+        _models[name] = model  # 登记模型，供HasMany按类名查找
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -136,6 +467,8 @@ class Model(dict, metaclass=ModelMetaclass):
     metaclass=ModelMetaclass表明创建Model的子类时，要通过ModelMetaclass类的__new__方法来创建
     """
 
+    __deferred__ = frozenset()  # 查询时未加载的列，需要await load()后才能访问
+
     def __init__(self, **kw):
         # 使用super()从父类中继承初始化方法
         super(Model, self).__init__(**kw)
@@ -145,6 +478,9 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError(
+                    r"'{}' is deferred, call 'await load()' first".format(key))
             raise AttributeError(
                 r"'Model' object has no attribute '{}'".format(key))
 
@@ -176,31 +512,140 @@ class Model(dict, metaclass=ModelMetaclass):
         """
         根据where条件查询数据
         findAll('id>?', ['0'],orderBy='name desc',limit=(1,1))
+        fields指定只查询哪些列（主键总会被查询），如 fields=('name', 'email')
+        defer指定暂不加载的列，如 defer=('content',)，之后可通过await load()加载
+        compact为True时返回只读的Record对象而不是Model，适合只用于展示的大量数据
         """
-        sql = [cls.__select__]
-        if where:  # 调用时示例: 'email=?'
-            sql.append('where')
-            sql.append(where)
+        fields = cls._normalize_fields(kw.get('fields', None), kw.get('defer', None))
+        compact = kw.get('compact', False)
         if args is None:
             args = []
+        else:
+            args = list(args)
         orderBy = kw.get('orderBy', None)  # 调用时示例： orderBy='name desc'
+        limit = kw.get('limit', None)  # 调用时示例： limit = 1 or limit = (1,1)
+        if limit is None:
+            shape = None
+        elif isinstance(limit, int):
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: {}'.format(str(limit)))
+        sql = cached_query((cls, where, orderBy, shape, fields),
+                           lambda: cls._build_select(where, orderBy, shape, fields))
+        logging.debug('SQL for findAll: %s\r\n ARGS:%s', sql, args)
+        rs = await select(sql, args, tuples=compact)
+        return cls._from_rows(rs, fields, compact)
+
+    @classmethod
+    def _normalize_fields(cls, fields, defer=None):
+        """校验并整理要查询的列，返回按定义顺序排列的tuple，None表示查询所有列"""
+        if fields is None and not defer:
+            return None
+        for f in tuple(fields or ()) + tuple(defer or ()):
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field for {}: {}'.format(cls.__name__, f))
+        return tuple(f for f in cls.__fields__
+                     if (fields is None or f in fields) and f not in (defer or ()))
+
+    @classmethod
+    def _from_rows(cls, rs, fields, compact=False):
+        """由查询结果生成实例列表，compact时rs为tuple行，生成Record"""
+        if compact:
+            columns = (cls.__primary_key__,) + tuple(cls.__fields__ if fields is None else fields)
+            make = cls.__record__._for_columns(columns)._make
+            return [make(columns, r) for r in rs]
+        return [cls._from_row(r, fields) for r in rs]
+
+    @classmethod
+    def _from_row(cls, row, fields):
+        """由查询结果生成实例，并记录未加载的列"""
+        obj = cls(**row)
+        if fields is not None:
+            object.__setattr__(obj, '__deferred__', frozenset(
+                f for f in cls.__fields__ if f not in fields))
+        return obj
+
+    @classmethod
+    def _select_clause(cls, fields):
+        """生成select ... from ...部分，fields为None时使用__select__"""
+        if fields is None:
+            return cls.__select__
+        return 'select `{}`{} from `{}`'.format(
+            cls.__primary_key__,
+            ''.join(', `{}`'.format(f) for f in fields),
+            cls.__table__)
+
+    @classmethod
+    def _build_select(cls, where, orderBy, shape, fields=None):
+        """拼接findAll的sql，shape为limit参数个数"""
+        sql = [cls._select_clause(fields)]
+        if where:  # 调用时示例: 'email=?'
+            sql.append('where')
+            sql.append(where)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kw.get('limit', None)  # 调用时示例： limit = 1 or limit = (1,1)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: {}'.format(str(limit)))
-        logging.info('SQL for findAll: {}\r\n ARGS:{}'.format(sql, args))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]  # **r表示以字典形式返回
+        if shape == 1:
+            sql.append('limit ?')
+        elif shape == 2:
+            sql.append('limit ?, ?')
+        return ' '.join(sql)
+
+    @classmethod
+    async def findByCursor(cls, where=None, args=None, after=None, before=None, limit=10,
+                           fields=None, defer=None, compact=False):
+        """
+        游标分页：按(created_at, 主键)倒序查询，直接定位到游标位置，不需要offset
+        after为上一页最后一条的(created_at, id)，before为下一页第一条的(created_at, id)
+        返回(数据列表, 该方向上是否还有更多数据)
+        findByCursor('blog_id=?', [blog_id], after=(1657177387.0, '0016...'))
+        """
+        fields = cls._normalize_fields(fields, defer)
+        args = [] if args is None else list(args)
+        direction = 'prev' if before is not None else 'next'
+        seek = before if before is not None else after
+        if seek is not None:
+            args.extend([seek[0], seek[0], seek[1]])
+        args.append(limit + 1)  # 多取一条用于判断是否还有下一页
+        sql = cached_query((cls, 'cursor', where, direction, seek is not None, fields),
+                           lambda: cls._build_cursor(where, direction, seek is not None, fields))
+        logging.debug('SQL for findByCursor: %s\r\n ARGS:%s', sql, args)
+        rs = await select(sql, args, tuples=compact)
+        has_more = len(rs) > limit
+        rs = list(rs[:limit])
+        if direction == 'prev':  # 往前翻页时是正序查询的，需要反转回倒序
+            rs.reverse()
+        return cls._from_rows(rs, fields, compact), has_more
+
+    @classmethod
+    def _build_cursor(cls, where, direction, has_seek, fields=None):
+        """拼接findByCursor的sql"""
+        pk = cls.__primary_key__
+        op, order = ('>', 'asc') if direction == 'prev' else ('<', 'desc')
+        conditions = []
+        if where:
+            conditions.append('({})'.format(where))
+        if has_seek:
+            conditions.append(
+                '(`created_at` {op} ? or (`created_at` = ? and `{pk}` {op} ?))'.format(op=op, pk=pk))
+        sql = [cls._select_clause(fields)]
+        if conditions:
+            sql.append('where')
+            sql.append(' and '.join(conditions))
+        sql.append('order by `created_at` {0}, `{1}` {0} limit ?'.format(order, pk))
+        return ' '.join(sql)
+
+    @classmethod
+    def _build_number(cls, selectField, where):
+        """拼接findNumber的sql"""
+        sql = 'select {} as _num_ from `{}`'.format(selectField, cls.__table__)
+        if where:
+            sql = '{} where {}'.format(sql, where)
+        return sql
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
@@ -208,29 +653,91 @@ class Model(dict, metaclass=ModelMetaclass):
         根据条件找出符合条件的第一条数据对应的值，不太明白这个函数在实际业务中有什么作用
         findNumber('email', 'id>?', [0])
         """
-        sql = [
-            'select {} as _num_ from `{}`'.format(
-                selectField,
-                cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        logging.info('SQL for findNumber: {}\r\n ARGS:{}'.format(sql, args))
-        rs = await select(' '.join(sql), args, 1)  # 只返回满足条件的第一条数据
+        sql = cached_query((cls, 'findNumber', selectField, where),
+                           lambda: cls._build_number(selectField, where))
+        logging.debug('SQL for findNumber: %s\r\n ARGS:%s', sql, args)
+        rs = await select(sql, args, 1)  # 只返回满足条件的第一条数据
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    async def countAll(cls):
+        """
+        返回表的总行数，代替每次都执行findNumber('count(id)')
+        结果缓存在进程内，save/remove时增量维护，超过ttl后重新与数据库对账；
+        若配置了estimate_rows，对账时先读取information_schema中的估算值，
+        估算值不小于estimate_rows时直接使用，避免对大表执行count扫描全表
+        """
+        c = _counts.get(cls.__table__)
+        now = time.time()
+        if c is not None and now - c[1] < _count_options['ttl']:
+            return c[0]
+        estimate_rows = _count_options['estimate_rows']
+        num = None
+        if estimate_rows is not None:
+            rs = await select(
+                'select table_rows as _num_ from information_schema.tables '
+                'where table_schema=database() and table_name=?', [cls.__table__], 1)
+            if len(rs) > 0 and rs[0]['_num_'] is not None and rs[0]['_num_'] >= estimate_rows:
+                num = rs[0]['_num_']
+        if num is None:  # 小表或未配置estimate_rows时精确计数
+            num = await cls.findNumber('count(`{}`)'.format(cls.__primary_key__))
+        _counts[cls.__table__] = [num or 0, now]
+        return num or 0
+
     @classmethod  # 该装饰器表明该方法为类方法，类不需要实例化就可以调用该方法
-    async def find(cls, pk):
+    async def find(cls, pk, fields=None, defer=None, include=None):
         """
         根据主键返回数据
         find('00165648325969327369a437c0b4951afcb743fe6f226b1000')
+        find(pk, defer=('content',))
+        include指定同时加载的关系，关联数据的查询与主查询并发执行，
+        可以是关系名列表，也可以是关系名 => findAll参数的字典：
+        find(pk, include=['comments'])
+        find(pk, include={'comments': dict(limit=(0, 20))})
         """
-        rs = await select('{} where `{}`=?'.format(cls.__select__, cls.__primary_key__), [pk], 1)
+        fields = cls._normalize_fields(fields, defer)
+        sql = cached_query((cls, 'find', fields), lambda: '{} where `{}`=?'.format(
+            cls._select_clause(fields), cls.__primary_key__))
+        if isinstance(include, (list, tuple)):
+            include = {name: {} for name in include}
+        names = list(include or {})
+        for name in names:
+            if name not in cls.__relations__:
+                raise ValueError('Invalid relation for {}: {}'.format(cls.__name__, name))
+        if names:
+            results = await gather(
+                select(sql, [pk], 1),
+                *[cls.__relations__[name].load(pk, **include[name]) for name in names])
+        else:  # 没有关联数据时直接查询，gather需要为每个查询创建task
+            results = [await select(sql, [pk], 1)]
+        rs = results[0]
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        obj = cls._from_row(rs[0], fields)
+        for name, items in zip(names, results[1:]):
+            obj[name] = items
+        return obj
+
+    async def load(self, *names):
+        """
+        加载查询时被延迟的列，不传names则加载全部未加载的列
+        blog = await Blog.find(id, defer=('content',))
+        await blog.load('content')
+        """
+        names = tuple(f for f in (names or self.__fields__)
+                      if f in self.__deferred__ and f not in self)
+        if names:
+            cls = self.__class__
+            sql = cached_query((cls, 'find', names), lambda: '{} where `{}`=?'.format(
+                cls._select_clause(names), cls.__primary_key__))
+            rs = await select(sql, [self.getValue(self.__primary_key__)], 1)
+            if len(rs) > 0:
+                for f in names:
+                    self[f] = rs[0][f]
+        object.__setattr__(self, '__deferred__', frozenset(
+            f for f in self.__deferred__ if f not in self))
 
     async def save(self):
         """
@@ -249,7 +756,9 @@ class Model(dict, metaclass=ModelMetaclass):
             self.getValueOrDefault(
                 self.__primary_key__))  # 获取主键的值并保存到args列表中
         rows = await execute(self.__insert__, args)
-        if rows != 1:
+        if rows == 1:
+            _adjust_count(self.__table__, 1)
+        else:
             logging.warning(
                 'failed to insert record; affected rows: %s'.format(rows))
 
@@ -267,6 +776,8 @@ class Model(dict, metaclass=ModelMetaclass):
         )
         await u.update()
         """
+        if self.__deferred__:  # 先加载未加载的列，避免被更新为空值
+            await self.load()
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
@@ -284,19 +795,93 @@ class Model(dict, metaclass=ModelMetaclass):
         """
         args = [self.getValue(self.__primary_key__)]  # 获取主键
         rows = await execute(self.__delete__, args)
-        if rows != 1:
+        if rows == 1:
+            _adjust_count(self.__table__, -1)
+        else:
             logging.warning(
                 'failed to remove by primary key: affected rows: {}'.format(rows))
 
+    @classmethod
+    async def save_all(cls, items, batch_size=100):
+        """
+        批量保存数据，每batch_size条生成一条多行insert语句，所有批次使用同一个连接
+        await Comment.save_all([Comment(...), Comment(...)])
+        """
+        columns = cls.__fields__ + [cls.__primary_key__]
+        row = '({})'.format(create_args_string(len(columns)))
+        statements = []
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            args = []
+            for item in batch:
+                args.extend(map(item.getValueOrDefault, columns))
+            sql = cached_query((cls, 'save_all', len(batch)), lambda: 'insert into `{}` ({}) values {}'.format(
+                cls.__table__, ','.join('`{}`'.format(f) for f in columns), ','.join([row] * len(batch))))
+            statements.append((sql, args))
+        async with transaction():  # 所有批次一次提交
+            rows = await execute_many(statements)
+        _adjust_count(cls.__table__, rows)
+        if rows != len(items):
+            logging.warning(
+                'failed to insert all records: {} of {} inserted'.format(rows, len(items)))
+        return rows
+
+    @classmethod
+    async def update_all(cls, where, values, args=None):
+        """
+        按条件批量更新，values为列名 => 新值
+        await Comment.update_all('blog_id=?', dict(user_name='xx'), [blog_id])
+        """
+        cls._normalize_fields(tuple(values))  # 校验列名
+        names = sorted(values)
+        sql = cached_query((cls, 'update_all', where, tuple(names)), lambda: 'update `{}` set {}{}'.format(
+            cls.__table__, ','.join('`{}`=?'.format(f) for f in names),
+            ' where {}'.format(where) if where else ''))
+        return await execute(sql, [values[f] for f in names] + list(args or []))
+
+    @classmethod
+    async def delete_where(cls, where, args=None):
+        """
+        按条件批量删除，返回删除的行数
+        await Comment.delete_where('id in (?,?)', [id1, id2])
+        """
+        if not where:
+            raise ValueError('delete_where requires a where clause')
+        sql = cached_query((cls, 'delete_where', where),
+                           lambda: 'delete from `{}` where {}'.format(cls.__table__, where))
+        rows = await execute(sql, list(args or []))
+        _adjust_count(cls.__table__, -rows)
+        return rows
+
+
+class HasMany(object):
+    """
+    一对多关系，model为关联模型的类名，foreign_key为关联模型中指向本模型主键的列
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
+    """
+
+    def __init__(self, model, foreign_key, orderBy=None):
+        self.model = model
+        self.foreign_key = foreign_key
+        self.orderBy = orderBy
+
+    async def load(self, pk, **kw):
+        """查询主键为pk的记录关联的数据，kw会传给findAll"""
+        kw.setdefault('orderBy', self.orderBy)
+        return await _models[self.model].findAll(
+            '`{}`=?'.format(self.foreign_key), [pk], **kw)
+
 
 class Field(object):
     """定义字段类型类"""
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key  # 是否是主键 True or False
         self.default = default  # 默认值
+        self.index = index  # 是否建立普通索引
+        self.unique = unique  # 是否建立唯一索引
 
     def __str__(self):  # __class__指向该实例对应的类，__class__.__name__获取该实例对应的类的名字
         return '<{}, {}: {}>'.format(
@@ -312,26 +897,28 @@ class StringField(Field):
             name=None,
             primary_key=False,
             default=None,
-            ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+            ddl='varchar(100)',
+            index=False,
+            unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=False):
-        super().__init__(name, 'boolean', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=False, index=False, unique=False):
+        super().__init__(name, 'boolean', primary_key, default, index, unique)
 
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.00):
-        super().__init__(name, 'float', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.00, index=False, unique=False):
+        super().__init__(name, 'float', primary_key, default, index, unique)
 
 
 class TextField(Field):
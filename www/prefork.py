@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+多进程运行：主进程fork出多个worker进程，每个worker有自己的事件循环，共享同一个端口
+- reuse_port=False：主进程创建监听socket，worker继承后使用
+- reuse_port=True：每个worker各自用SO_REUSEPORT绑定端口，由内核分配连接
+主进程收到SIGTERM/SIGINT时通知所有worker退出；收到SIGHUP时逐个平滑重启worker；
+worker意外退出时自动重新启动
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+
+
+def create_socket(host, port, reuse_port=False, backlog=128):
+    """创建监听socket"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Master(object):
+    """
+    管理worker进程
+    run_worker(sock, index)在子进程中调用，reuse_port时sock为None，由worker自己绑定端口
+    """
+
+    def __init__(self, run_worker, workers, host, port, reuse_port=False, backlog=128):
+        self.run_worker = run_worker
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.sock = None if reuse_port else create_socket(host, port, backlog=backlog)
+        self.children = {}  # pid => worker序号
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:  # 子进程
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                self.run_worker(self.sock, index)
+            except BaseException:
+                logging.exception('worker {} crashed'.format(index))
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        logging.info('worker {} started, pid {}'.format(index, pid))
+        return pid
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGTERM)
+
+    def reload(self, signum, frame):
+        self.reloading = True
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def restart_all(self):
+        """逐个替换worker：先启动新worker，再让旧worker处理完当前请求后退出"""
+        for pid, index in list(self.children.items()):
+            self.spawn(index)
+            self.kill(pid, signal.SIGTERM)
+            time.sleep(0.5)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for i in range(self.workers):
+            self.spawn(i)
+        while self.children:
+            if self.reloading:
+                self.reloading = False
+                logging.info('reloading workers...')
+                self.restart_all()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:  # 没有退出的worker，稍后再检查
+                time.sleep(0.2)
+                continue
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if not self.stopping and status != 0 and index not in self.children.values():
+                logging.warning('worker {} (pid {}) exited with status {}, restarting'.format(
+                    index, pid, status))
+                time.sleep(1)  # 避免启动即崩溃时不停重启
+                self.spawn(index)
+        logging.info('all workers stopped')
+        sys.exit(0)
+
+
+def serve(run_worker, workers, host, port, reuse_port=False, backlog=128):
+    Master(run_worker, workers, host, port, reuse_port, backlog).run()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+根据models.py中的模型生成建表语句，并与数据库中已有的表结构比对
+python3 schema.py dev          # 打印全部建表和建索引语句
+python3 schema.py dev diff     # 打印数据库中缺少的列和索引
+python3 schema.py dev migrate  # 执行数据库中缺少的列和索引
+"""
+
+import os
+import sys
+import asyncio
+import logging
+
+import orm
+
+
+# 建表时替换的类型：mysql的float是单精度，时间戳只能精确到约128秒，
+# 会破坏created_at的排序和游标分页的(created_at, id)比较，统一使用double
+_DDL_TYPES = {'float': 'double'}
+# information_schema中显示的类型与模型中的写法不同的情况
+_TYPE_ALIASES = {'boolean': ('tinyint(1)',), 'bigint': ('bigint(20)',),
+                 'double': ('real', 'double precision')}
+
+
+def ddl_type(field):
+    """字段在建表语句中使用的类型"""
+    return _DDL_TYPES.get(field.column_type.lower(), field.column_type)
+
+
+def same_type(db_type, column_type):
+    db_type = db_type.lower()
+    column_type = _DDL_TYPES.get(column_type.lower(), column_type.lower())
+    return db_type == column_type or db_type in _TYPE_ALIASES.get(column_type, ())
+
+
+def column_sql(name, field):
+    """生成单个列的定义"""
+    return '`{}` {} not null'.format(name, ddl_type(field))
+
+
+def create_table_sql(model):
+    """生成模型的建表语句和建索引语句"""
+    columns = [column_sql(k, model.__mappings__[k])
+               for k in [model.__primary_key__] + model.__fields__]
+    columns.append('primary key (`{}`)'.format(model.__primary_key__))
+    sqls = ['create table `{}` (\n  {}\n) engine=innodb default charset=utf8'.format(
+        model.__table__, ',\n  '.join(columns))]
+    sqls.extend(create_index_sql(model, *index) for index in model.__indexes__)
+    return sqls
+
+
+def create_index_sql(model, name, columns, unique):
+    return 'create {}index `{}` on `{}` ({})'.format(
+        'unique ' if unique else '', name, model.__table__,
+        ', '.join('`{}`'.format(c) for c in columns))
+
+
+async def diff_table_sql(model):
+    """与数据库中已有的表比对，返回需要执行的语句，只新增不删除"""
+    rs = await orm.select(
+        'select column_name as name, column_type as type from information_schema.columns '
+        'where table_schema=database() and table_name=?', [model.__table__])
+    if len(rs) == 0:  # 表不存在
+        return create_table_sql(model)
+    existing = {r['name']: r['type'] for r in rs}
+    sqls = []
+    for k in [model.__primary_key__] + model.__fields__:
+        field = model.__mappings__[k]
+        if k not in existing:
+            sqls.append('alter table `{}` add column {}'.format(
+                model.__table__, column_sql(k, field)))
+        elif not same_type(existing[k], field.column_type):
+            logging.warning('column type differs: {}.{} {} (model: {})'.format(
+                model.__table__, k, existing[k], ddl_type(field)))
+    rs = await orm.select(
+        'select index_name as name, column_name as col from information_schema.statistics '
+        'where table_schema=database() and table_name=? order by index_name, seq_in_index',
+        [model.__table__])
+    indexes = {}
+    for r in rs:
+        indexes.setdefault(r['name'], []).append(r['col'])
+    index_columns = [tuple(cols) for cols in indexes.values()]
+    for name, columns, unique in model.__indexes__:
+        if name not in indexes and tuple(columns) not in index_columns:
+            sqls.append(create_index_sql(model, name, columns, unique))
+    return sqls
+
+
+async def main(command):
+    import models
+    from config import configs
+    targets = [models.User, models.Blog, models.Comment]
+    if command == 'create':
+        for model in targets:
+            for sql in create_table_sql(model):
+                print('{};'.format(sql))
+        return
+    await orm.create_pool(
+        host=configs.db.host,
+        port=configs.db.port,
+        user=configs.db.user,
+        password=configs.db.password,
+        db=configs.db.database)
+    for model in targets:
+        for sql in await diff_table_sql(model):
+            print('{};'.format(sql))
+            if command == 'migrate':
+                await orm.execute(sql, ())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        exit('Usage: python3 schema.py dev|pro [create|diff|migrate]')
+    os.environ['app_env'] = sys.argv[1]
+    asyncio.get_event_loop().run_until_complete(
+        main(sys.argv[2] if len(sys.argv) == 3 else 'create'))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'komorebi'
+
+"""
+API返回值的JSON序列化
+安装了orjson时默认使用orjson，否则使用标准库json，可通过set_backend()指定
+"""
+
+import json
+import logging
+from operator import attrgetter
+
+from orm import Record
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoders = {}  # 类 => 将对象转换成可序列化对象的函数
+
+
+def _record_encoder(cls):
+    """为Record类预先生成转换函数，按类的__columns__（实际查询的列）一次attrgetter取出所有值"""
+    columns = cls.__columns__
+    if len(columns) == 1:  # 只有一列时attrgetter返回的不是tuple
+        column = columns[0]
+        return lambda o: {column: getattr(o, column)}
+    getter = attrgetter(*columns)
+    return lambda o: dict(zip(columns, getter(o)))
+
+
+def encoder_for(cls):
+    """获取cls对应的转换函数，结果按类缓存"""
+    encode = _encoders.get(cls)
+    if encode is None:
+        if issubclass(cls, Record):
+            encode = _record_encoder(cls)
+        elif hasattr(cls, 'to_dict'):
+            encode = cls.to_dict
+        else:
+            encode = attrgetter('__dict__')
+        _encoders[cls] = encode
+    return encode
+
+
+def default(o):
+    """json无法直接序列化的对象交给这里处理"""
+    try:
+        return encoder_for(o.__class__)(o)
+    except AttributeError:
+        raise TypeError('Object of type {} is not JSON serializable'.format(
+            o.__class__.__name__))
+
+
+def _dumps_json(obj):
+    # ensure_ascii=False汉字会正常显示不会被显示成ascii码表示
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+
+def _dumps_orjson(obj):
+    return orjson.dumps(obj, default=default)
+
+
+_backends = {'json': _dumps_json}
+if orjson is not None:
+    _backends['orjson'] = _dumps_orjson
+
+dumps = _backends.get('orjson', _dumps_json)  # 将对象序列化成utf-8编码的bytes
+
+
+def set_backend(name):
+    """指定序列化使用的库：auto、json或orjson，指定的库未安装时使用标准库json"""
+    global dumps
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in _backends:
+        logging.warning('json backend {} not available, use json'.format(name))
+        name = 'json'
+    dumps = _backends[name]
+    logging.info('json backend: {}'.format(name))